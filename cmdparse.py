@@ -4,8 +4,6 @@ This means stuff like "program command [options] [arguments]".  Inspired by
 Mercurial, it accepts any unambiguous abbreviation of known commands.
 Everything is done through the CommandParser and Command classes.
 
-Depends on miscutil.
-
 Python version: 2.
 Release: 6.
 
@@ -22,6 +20,8 @@ Command
 
 import sys
 import os
+from itertools import count
+from bisect import insort
 from textwrap import fill as tw_fill
 from math import ceil
 
@@ -30,11 +30,121 @@ try:
 except NameError:
     _ = lambda s: s
 
-from miscutil import startwith
+_fill_cache = {}
+_FILL_CACHE_SIZE = 256
 
 def fill (s, w):
-    """Like textwrap.fill, but preserve newlines (\n)."""
-    return '\n'.join(tw_fill(p, w) for p in s.split('\n'))
+    """Like textwrap.fill, but preserve newlines (\n).
+
+Recent results are cached, since the same text tends to get wrapped repeatedly.
+
+"""
+    try:
+        return _fill_cache[(s, w)]
+    except KeyError:
+        filled = '\n'.join(tw_fill(p, w) for p in s.split('\n'))
+        # keep the cache bounded for callers wrapping arbitrary text
+        if len(_fill_cache) >= _FILL_CACHE_SIZE:
+            _fill_cache.clear()
+        _fill_cache[(s, w)] = filled
+        return filled
+
+# every modification of a _Commands instance gets a new stamp
+_stamps = count()
+
+class _Commands (dict):
+    """A dict that records when it's modified, in its 'stamp' attribute."""
+
+    def __init__ (self, *args, **kw):
+        dict.__init__(self, *args, **kw)
+        self.stamp = next(_stamps)
+
+    def __setitem__ (self, k, v):
+        dict.__setitem__(self, k, v)
+        self.stamp = next(_stamps)
+
+    def __delitem__ (self, k):
+        dict.__delitem__(self, k)
+        self.stamp = next(_stamps)
+
+    def clear (self):
+        dict.clear(self)
+        self.stamp = next(_stamps)
+
+    def pop (self, *args):
+        rtn = dict.pop(self, *args)
+        self.stamp = next(_stamps)
+        return rtn
+
+    def popitem (self):
+        rtn = dict.popitem(self)
+        self.stamp = next(_stamps)
+        return rtn
+
+    def setdefault (self, *args):
+        rtn = dict.setdefault(self, *args)
+        self.stamp = next(_stamps)
+        return rtn
+
+    def update (self, *args, **kw):
+        dict.update(self, *args, **kw)
+        self.stamp = next(_stamps)
+
+def _parse_help (args):
+    """Option 'parser' for the help command."""
+    return args
+
+# A trie node is {first_char: (edge_label, child_node)}, with unary chains
+# compressed into a single edge (PATRICIA-style).  A node that ends a key has a
+# list of the values stored under that key in node[None].
+
+def _trie_add (node, key, value):
+    """Add a value to a trie under the given key."""
+    while key:
+        edge = node.get(key[0])
+        if edge is None:
+            node[key[0]] = (key, {None: [value]})
+            return
+        label, child = edge
+        # find length of common prefix
+        n = 1
+        max_n = min(len(label), len(key))
+        while n < max_n and label[n] == key[n]:
+            n += 1
+        if n < len(label):
+            # split the edge
+            child = {label[n]: (label[n:], child)}
+            node[key[0]] = (label[:n], child)
+        node = child
+        key = key[n:]
+    node.setdefault(None, []).append(value)
+
+def _trie_find (node, prefix):
+    """Return a list of all values in a trie with a key starting with prefix."""
+    while prefix:
+        edge = node.get(prefix[0])
+        if edge is None:
+            return []
+        label, node = edge
+        if len(prefix) <= len(label):
+            if label.startswith(prefix):
+                break
+            else:
+                return []
+        elif prefix.startswith(label):
+            prefix = prefix[len(label):]
+        else:
+            return []
+    # collect everything below this node
+    found = []
+    todo = [node]
+    while todo:
+        for k, v in todo.pop().iteritems():
+            if k is None:
+                found.extend(v)
+            else:
+                todo.append(v[1])
+    return found
 
 class CommandParser:
     """Command parser.
@@ -100,12 +210,14 @@ prog, full_prog, desc, tidying, case_sensitive: as given.
         self.case_sensitive = case_sensitive
         self._sort = sort
         self._cmds_order = []
-        self.cmds = dict((c.cmd, c) for c in cmds)
-        run_help = lambda cp, args: self.help(*args[:1])
-        parse = lambda args: args
+        self.cmds = _Commands((c.cmd, c) for c in cmds)
+        self._trie_stamp = self._trie_case_sensitive = None
+        # {(help, version): {flag: action}}, for parse
+        self._flags = {}
         self.add_cmd('help', _('print documentation for the given command'),
                      _('Without an argument, a list of commands is given.'),
-                     _('[COMMAND]'), run_help, parse, None, '__call__')
+                     _('[COMMAND]'), self._run_help, _parse_help, None,
+                     '__call__')
         self._do_exact = do_exact
 
     def add_cmd (self, *args, **kw):
@@ -118,24 +230,73 @@ Takes a Command instance or arguments to pass to Command to create one.
             c = args[0]
         else:
             c = Command(*args, **kw)
-        self._cmds_order.append(c.cmd)
-        if self._sort:
-            if hasattr(self._sort, '__call__'):
+        self._sync()
+        if c.cmd not in self.cmds:
+            _trie_add(self._trie, self._trie_key(c.cmd), c.cmd)
+        if not self._sort:
+            self._cmds_order.append(c.cmd)
+        elif hasattr(self._sort, '__call__'):
+            self._cmds_order.append(c.cmd)
+            if len(self._cmds_order) > 1:
                 self._cmds_order.sort(self._sort)
-            else:
-                self._cmds_order.sort()
+        else:
+            # already sorted
+            insort(self._cmds_order, c.cmd)
         self.cmds[c.cmd] = c
+        self._trie_stamp = self._cmds_stamp()
+
+    def _flag_action (self, arg, help, version):
+        """Return 'help', 'version' or None for a parse argument."""
+        try:
+            flags = self._flags[(help, version)]
+        except KeyError:
+            flags = self._flags[(help, version)] = dict.fromkeys(version,
+                                                                 'version')
+            flags.update(dict.fromkeys(help, 'help'))
+        except TypeError:
+            # unhashable flag lists: no caching
+            if arg in help:
+                return 'help'
+            return 'version' if arg in version else None
+        return flags.get(arg)
+
+    def _run_help (self, cp, args):
+        """Callback for the help command."""
+        self.help(*args[:1])
+
+    def _trie_key (self, cmd):
+        """Get the key used for a command in the trie."""
+        return cmd if self.case_sensitive else cmd.lower()
+
+    def _cmds_stamp (self):
+        """Get a value that changes whenever the commands in cmds change."""
+        cmds = self.cmds
+        if isinstance(cmds, _Commands):
+            return cmds.stamp
+        else:
+            # replaced by the user with some other dict: compare its keys
+            return frozenset(cmds)
+
+    def _sync (self):
+        """Rebuild the command trie if cmds has been changed directly."""
+        stamp = self._cmds_stamp()
+        if (self._trie_stamp != stamp or
+            self._trie_case_sensitive != self.case_sensitive):
+            self._trie = {}
+            for cmd in self.cmds:
+                _trie_add(self._trie, self._trie_key(cmd), cmd)
+            self._trie_stamp = stamp
+            self._trie_case_sensitive = self.case_sensitive
 
     def cmd_descs (self, *cmds):
         """Return aligned descriptions for the given commands."""
-        if not cmds:
-            cmds = self._cmds_order
-        descs = []
+        if cmds:
+            wanted = frozenset(cmds)
+            shown = [c for c in self._cmds_order if c in wanted]
+        else:
+            cmds = shown = self._cmds_order
         width = 4 * int(ceil((max(len(c) for c in cmds) + 2) / 4.))
-        # list comprehension faster than generator = silly
-        for cmd in [c for c in self._cmds_order if c in cmds]:
-            descs.append(cmd + ' ' * (width - len(cmd)) + self.cmds[cmd].desc)
-        return descs
+        return [cmd.ljust(width) + self.cmds[cmd].desc for cmd in shown]
 
     def full_cmd (self, cmd, can_die = False):
         """Return the matching full command(s) for the given input.
@@ -151,7 +312,8 @@ can_die: if True, call CommandParser.error if cmd doesn't match one command;
         if self._do_exact and cmd in self.cmds:
             cmds = [cmd]
         else:
-            cmds = startwith(self.cmds, cmd, self.case_sensitive)
+            self._sync()
+            cmds = _trie_find(self._trie, self._trie_key(cmd))
         if cmds:
             if can_die:
                 if len(cmds) > 1:
@@ -197,8 +359,8 @@ help: whether to display the full help listing before the error message.
         if cmd:
             # specific command
             cmd = self.cmds[self.full_cmd(cmd, True)]
-            desc = cmd.desc[0].upper() + cmd.desc[1:] + '.' if self.tidying else cmd.desc
-            print '{0} {1}\n\n{2}'.format(self.prog, cmd.usage, desc)
+            desc = cmd._tidied_desc if self.tidying else cmd.desc
+            print self.prog + ' ' + cmd.usage + '\n\n' + desc
             if cmd.long_desc:
                 print '\n', fill(cmd.long_desc, 79)
             if cmd.option_parser:
@@ -210,7 +372,7 @@ help: whether to display the full help listing before the error message.
             print self.full_prog, '\n'
             if self.desc:
                 print fill(self.desc, 79), '\n'
-            print '{0}:\n\n{1}'.format(_('Commands'), '\n'.join(self.cmd_descs()))
+            print _('Commands') + ':\n\n' + '\n'.join(self.cmd_descs())
 
     def parse (self, args = None, help = ('-h', '--help'),
                version = ('--version',)):
@@ -234,10 +396,11 @@ this is None.  Of course, this parser may also call sys.exit itself.
 """
         if args is None:
             args = sys.argv[1:]
-        if len(args) == 0 or args[0] in help:
+        action = self._flag_action(args[0], help, version) if args else 'help'
+        if action == 'help':
             self.help()
             sys.exit()
-        elif args[0] in version:
+        elif action == 'version':
             print self.full_prog
             sys.exit()
         else:
@@ -279,7 +442,8 @@ parser_parse: option_parser's method to parse options, taking a list of
                   callback = None, option_parser = None,
                   parser_option_help = 'format_option_help',
                   parser_parse = 'parse_args'):
-        self.cmd = cmd
+        # commands are looked up by name a lot
+        self.cmd = intern(cmd) if type(cmd) is str else cmd
         self.desc = desc
         self.long_desc = long_desc
         self.option_parser = option_parser
@@ -288,18 +452,32 @@ parser_parse: option_parser's method to parse options, taking a list of
         else:
             self.callback = None
         self.parser_option_help = parser_option_help
+        self._option_help = None
         self.parser_parse = parser_parse
         # construct usage string
         self.usage = self.cmd
         if args:
             self.usage += ' ' + args
+        # description as shown on the help page with tidying
+        if desc:
+            self._tidied_desc = desc[0].upper() + desc[1:] + '.'
+        else:
+            self._tidied_desc = desc
 
     def option_help (self):
-        """Wrapper using parser_option_help argument."""
-        if self.option_parser and self.parser_option_help is not None:
-            return getattr(self.option_parser, self.parser_option_help)()
-        else:
-            return ''
+        """Wrapper using parser_option_help argument.
+
+The result is cached, so changes to option_parser after this is first called
+aren't reflected.
+
+"""
+        if self._option_help is None:
+            if self.option_parser and self.parser_option_help is not None:
+                self._option_help = getattr(self.option_parser,
+                                            self.parser_option_help)()
+            else:
+                self._option_help = ''
+        return self._option_help
 
     def parse (self, args):
         """Wrapper using parser_parse argument."""
@@ -28,77 +28,95 @@ TODO:
 """
 
 from math import ceil, log
-from collections import OrderedDict
+from bisect import bisect
+from collections import OrderedDict, deque
 
 import pygame
 
-from miscutil import split
-
 _num = (int, long, float)
 
+def _split (size, intervals):
+    """Split an integer size into intervals sizes that differ by at most 1."""
+    if intervals <= 0:
+        return []
+    base, rem = divmod(size, intervals)
+    return [base + (i + 1) * rem / intervals - i * rem / intervals
+            for i in xrange(intervals)]
+
+def _const_vel_init (d, *vels):
+    if isinstance(vels[0], _num):
+        # just got one vel
+        vels = [vels]
+    else:
+        vels = [list(v) for v in vels]
+    vel = vels[0]
+    vels = vels[1:]
+    if not isinstance(vel[0], _num):
+        # remove time from first vel
+        vel = vel[0]
+    d.t = 0
+    d.real_pos = list(d.pos)
+    d.vel = vel
+    d.vels = deque(vels)
+
 def _const_vel (d, *vels):
-    if not hasattr(d, 'vel'):
-        if isinstance(vels[0], _num):
-            # just got one vel
-            vels = [vels]
-        else:
-            vels = [list(v) for v in vels]
-        vel = vels[0]
-        vels = vels[1:]
-        if not isinstance(vel[0], _num):
-            # remove time from first vel
-            vel = vel[0]
-        d.t = 0
-        d.real_pos = list(d.pos)
-        d.vel = vel
-        d.vels = vels
     vx, vy = d.vel
-    x, y = d.real_pos
-    x += vx
-    y += vy
-    d.real_pos = [x, y]
-    d.pos = [int(x), int(y)]
+    real_pos = d.real_pos
+    real_pos[0] += vx
+    real_pos[1] += vy
+    d.pos = [int(real_pos[0]), int(real_pos[1])]
     # get next vel if necessary
     vels = d.vels
     if vels:
         d.t += 1
         if d.t >= vels[0][1]:
-            d.vel = vels.pop(0)[0]
+            d.vel = vels.popleft()[0]
+
+def _const_vel_cleanup (d):
+    del d.t, d.real_pos, d.vel, d.vels
+
+def _damped_init (d, obj, inner, outer = None, speed = 0.5):
+    d_r = d.rect
+    if outer is None:
+        outer = d_r
+    rects = []
+    for r in (inner, outer):
+        if isinstance(r, _num):
+            r = (r * d_r[2], r * d_r[3])
+        if len(r) == 2:
+            offset = ((d_r[2] - r[0]) / 2, (d_r[3] - r[1]) / 2)
+            r = (d_r[0] + offset[0], d_r[1] + offset[1], r[0], r[1])
+        rects.append(pygame.Rect(r))
+    inner, outer = rects
+    if not outer.contains(inner):
+        msg = 'damped scrolling: outer rect must contain inner rect'
+        raise ValueError(msg)
+    # store as plain numbers so scrolling doesn't need to index a Rect
+    d.inner = (inner.left, inner.top, inner.right, inner.bottom)
 
 def _damped (d, obj, inner, outer = None, speed = 0.5):
-    if not hasattr(d, 'inner'):
-        d_r = d.rect
-        if outer is None:
-            outer = d_r
-        for attr, r in (('inner', inner), ('outer', outer)):
-            if isinstance(r, _num):
-                r = (r * d_r[2], r * d_r[3])
-            if len(r) == 2:
-                offset = ((d_r[2] - r[0]) / 2, (d_r[3] - r[1]) / 2)
-                r = (d_r[0] + offset[0], d_r[1] + offset[1], r[0], r[1])
-            setattr(d, attr, pygame.Rect(r))
-        if not d.outer.contains(d.inner):
-            msg = 'damped scrolling: outer rect must contain inner rect'
-            raise ValueError(msg)
-    p = []
-    for i in (0, 1):
-        # get amount to move to be in inner
-        a = d.inner[i]
-        b = a + d.inner[i + 2]
-        o = obj.pos[i]
-        x = d.pos[i]
-        if o < a:
-            diff = a - o
-        elif o > b:
-            diff = b - o
-        else:
-            diff = 0
-        x += diff * speed
-        p.append(x)
-    d.pos = p
-
+    l, t, r, b = d.inner
+    ox, oy = obj.pos
+    x, y = d.pos
+    # move by some of the distance to get obj in inner; in each direction, at
+    # most one of these terms is non-zero, since l <= r and t <= b
+    d.pos = [x + (max(l - ox, 0) + min(r - ox, 0)) * speed,
+             y + (max(t - oy, 0) + min(b - oy, 0)) * speed]
+
+def _damped_cleanup (d):
+    del d.inner
+
+def _init_scroll (d, *args):
+    # called on the first scroll with a built-in policy: initialise the policy
+    # (which might depend on the display's final rect), then use its scroll
+    # function from now on
+    POLICY_INIT[d.policy](d, *args)
+    d._scroll_fn = POLICY_SCROLL[d.policy]
+    d._scroll_fn(d, *args)
+
+POLICY_INIT = {'const_vel': _const_vel_init, 'damped': _damped_init}
 POLICY_SCROLL = {'const_vel': _const_vel, 'damped': _damped}
-POLICY_CLEANUP = {}
+POLICY_CLEANUP = {'const_vel': _const_vel_cleanup, 'damped': _damped_cleanup}
 
 class Display:
     """A basic display.
@@ -233,7 +251,7 @@ Call with no arguments to disable scrolling.
 """
         if policy == self.policy:
             # same policy; might want to change args/cleanup function, though
-            self._policy_args = args
+            self._policy_args = tuple(args) if args else ()
             if policy is not None and not isinstance(policy, basestring):
                 self._policy_cleanup = policy_cleanup
             return
@@ -257,10 +275,10 @@ Call with no arguments to disable scrolling.
             except AttributeError:
                 pass
         else:
-            self._policy_args = args if args else ()
+            self._policy_args = tuple(args) if args else ()
             if isinstance(policy, basestring):
                 # built-in
-                self._scroll_fn = POLICY_SCROLL[policy]
+                self._scroll_fn = _init_scroll
             else:
                 # custom
                 self._scroll_fn = policy
@@ -321,7 +339,7 @@ outside the screen entirely, ValueError is raised.
 """
         # first display argument is always rect; crop it to fit on the screen
         rect = pygame.Rect(display_args[0]).clip(self.screen.get_rect())
-        if any(rect.colliderect(d.rect) for d in self.displays):
+        if rect.collidelist([d.rect for d in self.displays]) != -1:
             raise ValueError('rect overlaps other displays')
         if rect.w == rect.h == 0:
             raise ValueError('rect outside of screen')
@@ -356,6 +374,9 @@ changed: a list of displays whose sizes or positions have changed.
         changed = []
         rects = []
         for display in self.displays:
+            if screen_rect.contains(display.rect):
+                # unaffected
+                continue
             # find display rect cropped to fit in new screen rect
             rect = display.rect.clip(screen_rect)
             if rect != display.rect:
@@ -380,7 +401,8 @@ Returns whether any changes were made to any screens.
         screen = self.screen
         dirty = False
         for display in self.displays:
-            dirty |= display.draw(screen)
+            if display.draw(screen):
+                dirty = True
         return dirty
 
 class LayeredDisplayManager (DisplayManager):
@@ -395,6 +417,11 @@ layers: a {z-index: displays} dict (collections.OrderedDict).
     def __init__ (self, screen = None):
         DisplayManager.__init__(self, screen)
         self.layers = OrderedDict()
+        # sorted z-indices of layers
+        self._zs = []
+        # all displays in the order they're drawn, and their z-indices
+        self._draw_order = []
+        self._draw_zs = []
 
     def open_display (self, z, *display_args, **kw):
         """Create a new display.
@@ -418,34 +445,40 @@ display: the created display.
             layer = self.layers[z]
         else:
             # new layer
+            i = bisect(self._zs, z)
+            self._zs.insert(i, z)
             self.layers[z] = layer = []
-            l = self.layers
-            # resort layers
-            self.layers = OrderedDict((z, l[z]) for z in sorted(l))
+            if i != len(self._zs) - 1:
+                # not the top layer: resort layers
+                l = self.layers
+                self.layers = OrderedDict((z, l[z]) for z in self._zs)
         # first display argument is always rect
         rect = pygame.Rect(display_args[0])
-        if any(rect.colliderect(d.rect) for d in layer):
+        if rect.collidelist([d.rect for d in layer]) != -1:
             raise ValueError('rect overlaps other displays in the same layer')
         new_disp = DisplayManager.open_display(self, rect, *display_args[1:],
                                                **kw)
         self.displays.append(new_disp)
         layer.append(new_disp)
+        i = bisect(self._draw_zs, z)
+        self._draw_order.insert(i, new_disp)
+        self._draw_zs.insert(i, z)
         # set some attributes on the display
         new_disp.z = z
         overlaps = []
         overlapped = []
         for layer, displays in self.layers.iteritems():
             if layer != z:
-                for display in displays:
-                    if display.rect.colliderect(rect):
-                        if layer < z:
-                            # get displays this one overlaps
-                            display.overlapped.append(new_disp)
-                            overlaps.append(display)
-                        elif layer > z:
-                            # get displays that overlap this one
-                            display.overlaps.append(new_disp)
-                            overlapped.append(display)
+                for i in rect.collidelistall([d.rect for d in displays]):
+                    display = displays[i]
+                    if layer < z:
+                        # get displays this one overlaps
+                        display.overlapped.append(new_disp)
+                        overlaps.append(display)
+                    else:
+                        # get displays that overlap this one
+                        display.overlaps.append(new_disp)
+                        overlapped.append(display)
         new_disp.overlaps = overlaps
         new_disp.overlapped = overlapped
         return new_disp
@@ -460,6 +493,9 @@ Doesn't draw over the display.
         # remove layer if empty now
         if not self.layers[z]:
             del self.layers[z]
+            self._zs.remove(z)
+        i = self._draw_order.index(display)
+        del self._draw_order[i], self._draw_zs[i]
         # remove display from overlaps/overlapped lists
         for disp in display.overlaps:
             disp.overlapped.remove(display)
@@ -474,15 +510,13 @@ Doesn't draw over the display.
         """Tell every display to draw, in layer order."""
         screen = self.screen
         dirty = False
-        for z, displays in self.layers.iteritems():
-            for display in displays:
-                drew = display.draw(screen)
-                # if made changes to the surface
-                if drew:
-                    # set any displays that overlap this one dirty
-                    for d in display.overlapped:
-                        d.dirty = True
-                dirty |= drew
+        for display in self._draw_order:
+            # if made changes to the surface
+            if display.draw(screen):
+                # set any displays that overlap this one dirty
+                for d in display.overlapped:
+                    d.dirty = True
+                dirty = True
         return dirty
 
 class SplitScreenDisplayManager (DisplayManager):
@@ -545,22 +579,26 @@ locked: whether this display manager is currently locked.
         # use screen aspect ratio if no preferred one given
         if ratio is None:
             ratio = float(size[0]) / size[1]
-        error = []
+        n_f = float(n)
+        invert = split_axis == 1
+        best = None
         for splits in xrange(1, n + 1):
             # maximal number of displays per row/column
-            per_split = ceil(float(n) / splits)
+            per_split = ceil(n_f / splits)
             # minimise unused space (as a fraction of the screen)
-            space_e = abs(1 - float(n) / (splits * per_split))
+            space_e = abs(1 - n_f / (splits * per_split))
             # and ratio (we care about proportionality, so use log)
             disp_ratio = float(s1 * splits) / (s2 * per_split)
-            if split_axis == 1:
+            if invert:
                 # inverted if splitting into columns
                 disp_ratio = 1 / disp_ratio
             ratio_e = abs(log(disp_ratio / ratio))
             # adjust using some constants
             e = space_e + ratio_e
-            error.append((e, splits))
-        return min(error)
+            # splits increases, so on a tie the existing best is smaller
+            if best is None or e < best[0]:
+                best = (e, splits)
+        return best
 
     def _arrange_displays (self):
         """Compute and apply optimal display rects.
@@ -586,11 +624,11 @@ Returns displays whose rects were changed.
         num_filled = splits - num_unfilled
         # decide display sizes
         screen_size = self.screen.get_size()
-        split_sizes = split(screen_size[not axis], splits)
+        split_sizes = _split(screen_size[not axis], splits)
         to_fill = screen_size[axis]
-        filled_sizes = split(to_fill, per_split)
+        filled_sizes = _split(to_fill, per_split)
         if self.expand:
-            unfilled_sizes = split(to_fill, per_split - 1)
+            unfilled_sizes = _split(to_fill, per_split - 1)
         else:
             unfilled_sizes = filled_sizes[:-1]
         # decide where unfilled splits go
@@ -605,7 +643,8 @@ Returns displays whose rects were changed.
         padding = to_fill - sum(unfilled_sizes)
         inner_padding = int(self.padding * padding)
         outer_padding = padding - inner_padding
-        padding = [outer_padding / 2] + split(inner_padding, per_split - 2)
+        # spread inner padding evenly over the gaps between displays
+        padding = [outer_padding / 2] + _split(inner_padding, per_split - 2)
         # construct rects and assign to displays
         displays = self.displays[:]
         changed = []
@@ -624,10 +663,10 @@ Returns displays whose rects were changed.
                     rect = [x, y, split_sizes[i], sizes[j]]
                 else:
                     rect = [y, x, sizes[j], split_sizes[i]]
-                rect = pygame.Rect(rect)
-                if rect != display.rect:
+                # Rect compares with sequences, so only create one if needed
+                if display.rect != rect:
                     changed.append(display)
-                    display.rect = rect
+                    display.rect = pygame.Rect(rect)
                 y += sizes[j]
             x += split_sizes[i]
         return changed
@@ -23,13 +23,25 @@ ff8: user-agent for Firefox 8.0.1 on Linux
 
 from os import sep as path_sep, makedirs
 from os.path import exists as path_exists
-from cStringIO import StringIO
+from collections import OrderedDict
 
 import pycurl
 
 ff8 = 'Mozilla/5.0 (X11; Linux i686; rv:8.0.1) Gecko/20100101 Firefox/8.0.1'
 ff19 = 'Mozilla/5.0 (X11; Linux x86_64; rv:19.0) Gecko/20100101 Firefox/19.0'
 
+# share DNS lookups and SSL sessions between all transfers
+_share = pycurl.CurlShare()
+_share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+if hasattr(pycurl, 'LOCK_DATA_SSL_SESSION'):
+    # not in older versions
+    _share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+
+# whether we can multiplex transfers over HTTP/2 connections
+_http2 = (all(hasattr(pycurl, attr) for attr in (
+    'VERSION_HTTP2', 'CURL_HTTP_VERSION_2TLS', 'M_PIPELINING', 'PIPE_MULTIPLEX'
+)) and bool(pycurl.version_info()[4] & pycurl.VERSION_HTTP2))
+
 def get (url, post = None, use = None, save = None, throttle = None,
          ua = ff19, store = None, httppost = False, info = False):
     """Fetch a single page using cURL.
@@ -50,17 +62,23 @@ info: instead of just the data, return (data, response_code, effective_url),
       or just the latter two if saving to file.
 
 """
-    f = StringIO() if store is None else open(store, 'wb')
     c = pycurl.Curl()
     # compulsory settings
     c.setopt(pycurl.URL, url)
-    c.setopt(pycurl.WRITEFUNCTION, f.write)
+    if store is None:
+        buf = bytearray()
+        c.setopt(pycurl.WRITEFUNCTION, buf.extend)
+    else:
+        f = open(store, 'wb')
+        # libcurl writes to the file itself
+        c.setopt(pycurl.WRITEDATA, f)
     c.setopt(pycurl.FOLLOWLOCATION, 1)
     c.setopt(pycurl.MAXREDIRS, 5)
     c.setopt(pycurl.CONNECTTIMEOUT, 30)
     c.setopt(pycurl.TIMEOUT, 60)
     c.setopt(pycurl.NOSIGNAL, 1)
     c.setopt(pycurl.USERAGENT, ua)
+    c.setopt(pycurl.SHARE, _share)
     # optional settings
     if post:
         if httppost:
@@ -82,8 +100,9 @@ info: instead of just the data, return (data, response_code, effective_url),
             result.append('')
     else:
         if store is None:
-            result.append(f.getvalue())
-            f.close()
+            result.append(str(buf))
+    if store is not None:
+        f.close()
     if info:
         result.append(c.getinfo(pycurl.RESPONSE_CODE))
         result.append(c.getinfo(pycurl.EFFECTIVE_URL))
@@ -133,15 +152,13 @@ Also sets user-agent to Firefox 4 on Linux to avoid rejection as a bot.
         names = urls
     if err_names is None:
         err_names = names
-    temp, names = names, {}
-    for i in xrange(len(urls)):
-        names[urls[i]] = temp[i]
-    temp, err_names = err_names, {}
-    for i in xrange(len(urls)):
-        err_names[urls[i]] = temp[i]
+    names = dict(zip(urls, names))
+    err_names = dict(zip(urls, err_names))
     # set up storage
     retries = max(0, retries)
-    queue = [(url, retries) for url in set(urls)]
+    # fetch in the given order (URLs are popped from the end)
+    queue = [(url, retries) for url in OrderedDict.fromkeys(urls)]
+    queue.reverse()
     if folder is None:
         data = dict(((x[0], None) for x in queue))
     else:
@@ -149,26 +166,36 @@ Also sets user-agent to Firefox 4 on Linux to avoid rejection as a bot.
             folder += path_sep
         if not path_exists(folder):
             makedirs(folder)
-        data = {}
-        for x in queue:
-            if files is None:
-                data[x[0]] = str(id(x[0]))
-            else:
-                data[x[0]] = files[urls.index(x[0])]
+        if files is None:
+            data = dict((x[0], str(id(x[0]))) for x in queue)
+        else:
+            # use the file given for the first occurrence of each URL
+            data = {}
+            for url, fn in zip(urls, files):
+                data.setdefault(url, fn)
     cons = max(min(cons, len(queue)), 1)
 
     # initialise cURL stuff
     m = pycurl.CurlMulti()
+    if _http2:
+        m.setopt(pycurl.M_PIPELINING, pycurl.PIPE_MULTIPLEX)
     m.handles = []
     for i in xrange(cons):
         c = pycurl.Curl()
         c.out = None
+        if folder is None:
+            # reused for every page this handle fetches
+            c.buf = bytearray()
+            c.setopt(pycurl.WRITEFUNCTION, c.buf.extend)
         c.setopt(pycurl.FOLLOWLOCATION, 1)
         c.setopt(pycurl.MAXREDIRS, 5)
         c.setopt(pycurl.CONNECTTIMEOUT, 30)
         c.setopt(pycurl.TIMEOUT, 60)
         c.setopt(pycurl.NOSIGNAL, 1)
         c.setopt(pycurl.USERAGENT, ff8)
+        c.setopt(pycurl.SHARE, _share)
+        if _http2:
+            c.setopt(pycurl.HTTP_VERSION, pycurl.CURL_HTTP_VERSION_2TLS)
         if cookie is not None:
             c.setopt(pycurl.COOKIEFILE, cookie)
         if throttle is not None:
@@ -185,30 +212,28 @@ Also sets user-agent to Firefox 4 on Linux to avoid rejection as a bot.
             url, retries = queue.pop()
             c = free.pop()
             if folder is None:
-                c.out = StringIO()
+                del c.buf[:]
             else:
                 c.out = open(folder + data[url], 'wb')
+                c.setopt(pycurl.WRITEDATA, c.out)
             c.setopt(pycurl.URL, url)
-            c.setopt(pycurl.WRITEFUNCTION, c.out.write)
             m.add_handle(c)
             c.url, c.retries = url, retries
-        while True:
-            ret, num_handles = m.perform()
-            if ret != pycurl.E_CALL_MULTI_PERFORM:
-                break
+        m.perform()
         # sort out finished downloads
         while True:
             num_q, done, err = m.info_read()
             for c in done:
                 has_err = False
                 if folder is None:
-                    p = c.out.getvalue()
+                    p = str(c.buf)
                     s = p if func is None else func(p)
                     if s is False:
                         has_err = True
                     else:
                         data[c.url] = s
-                c.out.close()
+                else:
+                    c.out.close()
                 if folder is not None and func is not None:
                     with open(folder + data[c.url]) as f:
                         page = f.read()
@@ -236,14 +261,19 @@ Also sets user-agent to Firefox 4 on Linux to avoid rejection as a bot.
                 else:
                     failed.append(c.url)
                     left -= 1
-                c.out.close()
-                c.out = None
+                if c.out is not None:
+                    c.out.close()
+                    c.out = None
                 m.remove_handle(c)
                 free.append(c)
             if num_q == 0:
                 break
-        # idle for a bit
-        m.select(1.)
+        # wait for activity, unless finished transfers freed up connections
+        # for queued URLs; cURL tells us how long it can wait (-1 if it
+        # doesn't mind)
+        if not (queue and free):
+            t = m.timeout()
+            m.select(1. if t < 0 else min(t / 1000., 1.))
 
     # clean up
     for c in m.handles:
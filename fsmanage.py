@@ -29,6 +29,10 @@ buttons
 # - sort options: natural, case-sensitive
 # - copy, move backend functions should return new files on success, and use this to end up with correct focus
 
+import re
+from collections import OrderedDict, deque
+from functools import partial
+from weakref import ref
 from pickle import dumps, loads
 from base64 import encodebytes, decodebytes
 
@@ -50,15 +54,31 @@ COL_ICON = 1
 COL_NAME = 2
 COL_COLOUR = 3
 COL_EDITABLE = 4
-COL_LAST = 4
+COL_SORT_KEY = 5
+COL_LAST = 5
 
 NAME_COLOUR = '#000'
 NAME_COLOUR_CUT = '#666'
+# indexed by is_dir
+ICONS = (gtk.STOCK_FILE, gtk.STOCK_DIRECTORY)
+MAX_HISTORY = 256
+NEW_DIR_NAME = re.compile(r'new \((\d+)\)')
 
 dp = gtk.TreeViewDropPosition
 MOVE_BTN = gdk.ModifierType.BUTTON1_MASK
 COPY_BTN = gdk.ModifierType.BUTTON2_MASK
 
+def _widget_cb (widget, cb, *args):
+    """Widget signal callback that calls cb(*args)."""
+    cb(*args)
+
+def _accel_cb (manager_ref, cb, args, *accel_args):
+    """Accelerator callback that calls cb(manager, *args) if it has focus."""
+    manager = manager_ref()
+    if manager is not None and manager.is_focus():
+        cb(manager, *args)
+
+
 class Manager (gtk.TreeView):
     """A filesystem viewer (and manager).  Subclass of Gtk.TreeView.
 
@@ -73,7 +93,7 @@ by ['some', 'path', 'current_dir'].
 
 Manager(backend, path = [], read_only = False, cache = False,
         allow_nav = True, extra_cols = [], identifier = 'fsmanage',
-        disabled_accels = ())
+        disabled_accels = (), max_cache_entries = 128)
 
 backend: an object with methods as follows.  Any method that changes the
          directory tree should not return until any call to list_dir will
@@ -98,6 +118,11 @@ backend: an object with methods as follows.  Any method that changes the
                 open_files/open_dirs is called if it exists in preference to
                 this function.
 
+    dir_mtime: this is optional.  It takes a directory path and returns
+               something (such as the modification time) that changes whenever
+               the directory's contents change.  If supported, cached
+               listings are only used while this value is unchanged.
+
          The following are only required if read_only is False.  They should
          each return True if the action is taken, else False.
 
@@ -159,6 +184,9 @@ disabled_accels: you might want to disable some keyboard accelerators and not
     Delete: delete
     F2: rename
     <ctrl>n: new directory
+max_cache_entries: the maximum number of directories to keep in the cache; the
+                   least recently used are dropped first.  None means no
+                   limit.
 
     METHODS
 
@@ -179,7 +207,7 @@ present_item
 
     ATTRIBUTES
 
-backend, read_only, identifier, allow_nav: as given.
+backend, read_only, identifier, allow_nav, max_cache_entries: as given.
 path: as given; change it with the set_path method.
 cache: as given.  Setting this to False will disable further caching, but not
        clear the existing cache; use the clear_cache method for this.
@@ -199,6 +227,10 @@ manager.set_rubber_banding(False)
     (default: True)
 manager.set_tooltip_column(column)
     (default: not set)
+manager.set_fixed_height_mode(True)
+    (default: True if there are no displayed extra columns; to use this with
+    extra columns, first give each of them fixed sizing with
+    Gtk.TreeViewColumn.set_sizing)
 
 Note that column can be one of the COL_* attributes of this module, or for an
 extra column, fsmanage.COL_LAST + i + 1, where i is the column's index in the
@@ -208,16 +240,23 @@ extra_cols argument.
 
     def __init__ (self, backend, path = [], read_only = False, cache = False,
                   allow_nav = True, extra_cols = [], identifier = 'fsmanage',
-                  disabled_accels = ()):
+                  disabled_accels = (), max_cache_entries = 128):
         self.backend = backend
         self.path = list(path)
         self.read_only = read_only
         self.cache = cache
         self.allow_nav = allow_nav
         self.identifier = identifier
-        self._cache = {}
+        self.max_cache_entries = max_cache_entries
+        self._cache = OrderedDict()
+        # directory shown in the model, and name -> TreeIter for its rows;
+        # only _refresh may add or remove rows, else these iters go stale
+        self._model_path = None
+        self._rows = {}
+        # reference to the row being renamed
+        self._editing = None
         self._clipboard = None
-        self._history = [self.path]
+        self._history = deque([self.path], MAX_HISTORY)
         self._hist_sel = {}
         self._hist_focus = {}
         self._hist_pos = 0
@@ -225,7 +264,7 @@ extra_cols argument.
         self.address_bar = None
 
         # interface
-        self._model = gtk.ListStore(bool, str, str, str, bool,
+        self._model = gtk.ListStore(bool, str, str, str, bool, str,
                                     *(str for c in extra_cols))
         gtk.TreeView.__init__(self, self._model)
         self.get_selection().set_mode(gtk.SelectionMode.MULTIPLE)
@@ -250,8 +289,13 @@ extra_cols argument.
         self.connect('row-activated', self._open)
         self.connect('button-press-event', self._click)
         # columns
-        c = gtk.TreeViewColumn('', gtk.CellRendererPixbuf(),
-                               stock_id = COL_ICON)
+        # every row is the same height, so fixed-size columns let GTK skip
+        # measuring each row
+        r = gtk.CellRendererPixbuf()
+        c = gtk.TreeViewColumn('', r, stock_id = COL_ICON)
+        c.set_sizing(gtk.TreeViewColumnSizing.FIXED)
+        icon_w = gtk.icon_size_lookup(r.get_property('stock-size'))[1]
+        c.set_fixed_width(icon_w + 2 * r.get_property('xpad') + 4)
         self.append_column(c)
         r = gtk.CellRendererText()
         r.set_property('foreground-set', True)
@@ -261,8 +305,10 @@ extra_cols argument.
         c = gtk.TreeViewColumn(_('Name'), r, text = COL_NAME,
                                foreground = COL_COLOUR,
                                editable = COL_EDITABLE)
+        c.set_sizing(gtk.TreeViewColumnSizing.FIXED)
         c.set_expand(True)
         self.append_column(c)
+        self._name_column = c
         # extra columns
         i = 1
         for c in extra_cols:
@@ -282,10 +328,13 @@ extra_cols argument.
                 c.set_expand(True)
             self.append_column(c)
             i += 1
-        # sorting
-        self._model.set_default_sort_func(self._sort_tree)
-        # FIXME: -1 should be DEFAULT_SORT_COLUMN_ID, but I can't find it
-        self._model.set_sort_column_id(-1, gtk.SortType.ASCENDING)
+        # extra columns size to their contents, which fixed-height mode
+        # doesn't allow
+        if i == 1:
+            self.set_fixed_height_mode(True)
+        self.set_show_expanders(False)
+        # sorting: dirs first, then case-insensitive by name
+        self._model.set_sort_column_id(COL_SORT_KEY, gtk.SortType.ASCENDING)
         # accelerators
         group = self.accel_group = gtk.AccelGroup()
         accels = [
@@ -310,15 +359,14 @@ extra_cols argument.
                 ('F2', self.rename),
                 ('<ctrl>n', self.new_dir)
             ]
-        def mk_fn (cb, *cb_args):
-            def f (*args):
-                if self.is_focus():
-                    cb(*cb_args)
-            return f
+        # only hold a weak reference to ourself, so the accel group doesn't
+        # keep us alive
+        self_ref = ref(self)
         for accel, cb, *args in accels:
             if accel not in disabled_accels:
                 key, mods = gtk.accelerator_parse(accel)
-                group.connect(key, mods, 0, mk_fn(cb, *args))
+                group.connect(key, mods, 0, partial(_accel_cb, self_ref,
+                                                    cb.__func__, args))
 
         self.refresh()
 
@@ -341,7 +389,6 @@ extra_cols argument.
         # - maybe GTK stores it in such a way that the garbage collector thinks
         # it can get rid of it or something
         menu = self._temp_menu = gtk.Menu()
-        f = lambda widget, cb, *args: cb(*args)
         for x in actions:
             if x is None:
                 item = gtk.SeparatorMenuItem()
@@ -354,7 +401,7 @@ extra_cols argument.
                     item.set_use_underline(True)
                 if tooltip is not None:
                     item.set_tooltip_text(tooltip)
-                item.connect('activate', f, cb, *cb_args)
+                item.connect('activate', _widget_cb, cb, *cb_args)
             menu.append(item)
         menu.show_all()
         menu.popup(*menu_args)
@@ -680,11 +727,10 @@ extra_cols argument.
 
     def _cancel_rename (self, renderer):
         """Cancel renaming callback."""
-        name = renderer.get_property('text')
-        for row in self._model:
-            if row[COL_NAME] == name:
-                row[COL_EDITABLE] = False
-                return
+        row_ref = self._editing
+        self._editing = None
+        if row_ref is not None and row_ref.valid():
+            self._model[row_ref.get_path()][COL_EDITABLE] = False
 
     def _done_rename (self, renderer, path, text):
         """Rename callback."""
@@ -694,25 +740,30 @@ extra_cols argument.
         if old == new:
             # unedit
             row[COL_EDITABLE] = False
+            self._editing = None
             return
         if self.backend.move((old, new)):
+            self._editing = None
             self._refresh(True, (old[-1], new[-1]))
         else:
-            # failed; reselect
+            # failed; reselect (row is still editable)
             self._edit(path)
 
     def _edit (self, path):
         """Edit the name at the given TreeModel path."""
         if not isinstance(path, gtk.TreePath):
             path = gtk.TreePath(path)
-        self.set_cursor(path, self.get_column(1), True)
+        self.set_cursor(path, self._name_column, True)
 
     def _rename (self, paths):
         """Rename the first of the given TreeModel paths."""
         if not paths:
             return
         path = paths[0]
+        if not isinstance(path, gtk.TreePath):
+            path = gtk.TreePath(path)
         self._model[path][COL_EDITABLE] = True
+        self._editing = gtk.TreeRowReference.new(self._model, path)
         self._edit(path)
 
     def rename (self):
@@ -723,13 +774,13 @@ extra_cols argument.
         """Create a new directory here."""
         if self.read_only:
             return
-        # find a name not already used
-        names = [row[2] for row in self._model]
-        i = 1
+        # find a name not already used: after the highest 'new (i)'
+        names = self._rows
         name = 'new'
-        while name in names:
-            i += 1
-            name = 'new ({})'.format(i)
+        if name in names:
+            used = (NEW_DIR_NAME.fullmatch(n) for n in names)
+            i = max((int(m.group(1)) for m in used if m), default = 1)
+            name = 'new ({})'.format(i + 1)
         # create it
         if not self.backend.new_dir(self.path + [name]):
             # failed
@@ -739,13 +790,35 @@ extra_cols argument.
         while gtk.events_pending():
             gtk.main_iteration()
         # find it in the tree and start editing it
-        j = None
-        for i, row in enumerate(self._model):
-            if name == row[2]:
-                j = i
-                break
-        if j is not None:
-            self._rename([j])
+        it = self._rows.get(name)
+        if it is not None:
+            self._rename([self._model.get_path(it)])
+
+    def _list_dir (self, path, purge_cache = False):
+        """Get a directory's contents, using the cache if possible."""
+        key = tuple(path)
+        cache = self._cache
+        mtime = None
+        get_mtime = getattr(self.backend, 'dir_mtime', None)
+        if get_mtime is not None and (self.cache or key in cache):
+            mtime = get_mtime(path)
+        # try to retrieve from cache
+        if not purge_cache and key in cache:
+            cached_mtime, items = cache[key]
+            if cached_mtime == mtime:
+                cache.move_to_end(key)
+                return items
+        # request listing
+        items = self.backend.list_dir(path)
+        # store in cache, dropping the least recently used
+        if self.cache:
+            cache[key] = (mtime, items)
+            cache.move_to_end(key)
+            n = self.max_cache_entries
+            if n is not None:
+                while len(cache) > n:
+                    cache.popitem(False)
+        return items
 
     def refresh (self, *new):
         """Refresh the directory listing.
@@ -799,20 +872,8 @@ preserve_sel: whether to try to preserve the selection over the refresh
         else:
             sel_from_hist = True
             del self._hist_sel[tuple(path)], self._hist_focus[tuple(path)]
-        # clear model
         model = self._model
-        model.clear()
-        # try to retrieve from cache
-        try:
-            if purge_cache:
-                raise KeyError()
-            items = self._cache[tuple(path)]
-        except KeyError:
-            # request listing
-            items = self.backend.list_dir(path)
-            # store in cache
-            if self.cache:
-                self._cache[tuple(path)] = items
+        items = self._list_dir(path, purge_cache)
         # disable sorting
         # FIXME: -2 should be UNSORTED_SORT_COLUMN_ID, but I can't find it
         model.set_sort_column_id(-2, gtk.SortType.ASCENDING)
@@ -820,19 +881,48 @@ preserve_sel: whether to try to preserve the selection over the refresh
         cb = self._clipboard
         if cb is not None:
             cb = cb[0] if cb[1] else False
-        DIR = gtk.STOCK_DIRECTORY
-        FILE = gtk.STOCK_FILE
-        for name, is_dir, *extra_vals in items:
-            icon = DIR if is_dir else FILE
-            if cb and path + [name] in cb:
-                colour = NAME_COLOUR_CUT
-            else:
-                colour = NAME_COLOUR
-            model.append((is_dir, icon, name, colour, False) +
-                         tuple(extra_vals))
+        # names of cut files in this directory
+        cut = {f[-1] for f in cb if f[:-1] == path} if cb else ()
+        # sort key puts dirs first
+        rows = [[bool(is_dir), ICONS[bool(is_dir)], name,
+                 NAME_COLOUR_CUT if name in cut else NAME_COLOUR, False,
+                 ('1', '0')[bool(is_dir)] + name.lower()] + extra_vals
+                for name, is_dir, *extra_vals in items]
+        cols = list(range(model.get_n_columns()))
+        # Gtk.ListStore.insert converts values to the column types
+        insert = model.insert
+        same_dir = tuple(path) == self._model_path
+        if same_dir:
+            # same directory: only apply what changed
+            self.get_selection().unselect_all()
+            current = self._rows
+            new_rows = {row[COL_NAME]: row for row in rows}
+            # keep renamed rows in place
+            for old, new in changes:
+                if (old in current and old not in new_rows and
+                    new in new_rows and new not in current):
+                    current[new] = current.pop(old)
+            for name in [name for name in current if name not in new_rows]:
+                model.remove(current.pop(name))
+            for name, row in new_rows.items():
+                try:
+                    it = current[name]
+                except KeyError:
+                    current[name] = insert(-1, row)
+                else:
+                    if list(model.get(it, *cols)) != row:
+                        model.set(it, cols, row)
+        else:
+            # detach the model while filling it, so the view doesn't react to
+            # each row (the cursor is restored below)
+            self.set_model(None)
+            model.clear()
+            self._rows = {row[COL_NAME]: insert(-1, row)
+                          for row in rows}
+            self._model_path = tuple(path)
+            self.set_model(model)
         # enable sorting again
-        # FIXME: -1 should be DEFAULT_SORT_COLUMN_ID, but I can't find it
-        model.set_sort_column_id(-1, gtk.SortType.ASCENDING)
+        model.set_sort_column_id(COL_SORT_KEY, gtk.SortType.ASCENDING)
         # restore focus
         names = {row[COL_NAME]: i for i, row in enumerate(model)}
         try:
@@ -863,7 +953,8 @@ preserve_sel: whether to try to preserve the selection over the refresh
         # else if selected anything new, scroll to the first of these
         elif new_selected:
             self.scroll_to_cell(min(new_selected), use_align = False)
-        elif items:
+        # else keep the scroll position if we're still in the same directory
+        elif items and not same_dir:
             self.scroll_to_cell(0)
 
     def set_path (self, path, add_to_hist = True, tell_address_bar = True):
@@ -882,8 +973,13 @@ tell_address_bar: whether to notify the AddressBar instance associated with
             return
         # history
         if add_to_hist:
-            self._hist_pos += 1
-            self._history = self._history[:self._hist_pos] + [path]
+            hist = self._history
+            # drop forwards history
+            for i in range(len(hist) - 1 - self._hist_pos):
+                hist.pop()
+            # oldest entry is dropped if full
+            hist.append(path)
+            self._hist_pos = len(hist) - 1
         self._hist_sel[tuple(self.path)] = self.get_selected_files()
         focus = self.get_cursor()[0]
         if focus is not None:
@@ -948,7 +1044,7 @@ dirs: if none are given, clear all cache; otherwise, clear the cache for these
                 except KeyError:
                     pass
         else:
-            self._cache = {}
+            self._cache.clear()
 
     def present_item (self, item):
         """Present a file or directory to the user.
@@ -976,23 +1072,6 @@ selects and focuses it, and scrolls so that it is in view.
         self.set_cursor(i, None, False)
         self.scroll_to_cell(i, use_align = False)
 
-    def _sort_tree (self, model, iter1, iter2, data):
-        """Sort callback."""
-        row1 = model[iter1]
-        is_dir1 = row1[COL_IS_DIR]
-        row2 = model[iter2]
-        is_dir2 = row2[COL_IS_DIR]
-        # dirs first
-        if is_dir1 != is_dir2:
-            return 1 if is_dir2 else -1
-        # if either name is None, it's not in the model yet
-        name1 = row1[COL_NAME].lower()
-        name2 = row2[COL_NAME].lower()
-        if None in (name1, name2):
-            return 0
-        # alphabetical
-        return 1 if name1 > name2 else (0 if name1 is name2 else -1)
-
 
 class AddressBar (gtk.Box):
     """An address bar to work with a Manager.  Subclass of Gtk.Box.
@@ -1138,23 +1217,15 @@ This does not affect the manager.
         """Update the breadcrumbs path bar."""
         path = self.path
         bc = self.breadcrumbs
-        # remove children we don't want any more
+        # remove children after where the paths differ (keep any after the
+        # current dir if it's a prefix, for going forwards)
         bc_path = self._bc_path
-        full_path = path + [None] * (len(bc_path) - len(path))
-        rm = False
-        i = 0
-        while i < len(bc_path):
-            bc_d = bc_path[i]
-            d = full_path[i]
-            if not rm and d is not None and bc_d != d:
-                rm = True
-            if rm:
-                bc_path.pop(i)
-            else:
-                i += 1
+        for i, (bc_d, d) in enumerate(zip(bc_path, path)):
+            if bc_d != d:
+                del bc_path[i:]
+                break
         # add extra children
-        for d in path[len(bc_path):]:
-            bc_path.append(d)
+        bc_path.extend(path[len(bc_path):])
         # remove all children from bar
         for c in bc.get_children():
             bc.remove(c)
@@ -1285,7 +1356,6 @@ button_list: a list of Gtk.Button instances: back, forward, up, new, in that
     if not m.read_only:
         button_data.append((gtk.STOCK_NEW, _('Create directory'), m.new_dir))
     # create and add buttons
-    f = lambda widget, cb, *args: cb(*args)
     for name, tooltip, cb, *cb_args in button_data:
         if name.startswith('gtk-'):
             b = gtk.Button(stock=name, use_stock=True)
@@ -1293,7 +1363,7 @@ button_list: a list of Gtk.Button instances: back, forward, up, new, in that
             b = gtk.Button(name, use_underline=('_' in name))
         buttons.append(b)
         b.set_tooltip_text(tooltip)
-        b.connect('clicked', f, cb, *cb_args)
+        b.connect('clicked', _widget_cb, cb, *cb_args)
     # remove button labels
     if not labels:
         for b in buttons: